@@ -1,9 +1,15 @@
 
 from __future__ import annotations
 
+import json
+import logging
 import sqlite3
+from itertools import islice
 from pathlib import Path
-from typing import Iterable, Tuple, Any
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Any
+
+# Modulens logger, barn till "etl_cars" så att ETL:ens hanterare används
+LOGGER = logging.getLogger("etl_cars.db_cars")
 
 # DDL: skapar tabellen om den inte finns.
 
@@ -18,52 +24,131 @@ create table if not exists fact_cars (
     body_type        text,
     horsepower       integer check (horsepower is null or horsepower >= 0),
     price_per_1000km real    check (price_per_1000km is null or price_per_1000km >= 0),
-    load_ts          text not null
+    load_ts          text not null,
+    row_hash         integer
 );
 -- Index för snabbare sökning på registreringsnummer
 create unique index if not exists ux_fact_cars_regnr on fact_cars(regnr);
 """
 
-# UPSERT: vid konflikter på url uppdateras fälten med "excluded" värden (SQL standard).
-UPSERT_SQL = """
+# Rader delas upp i nya (INSERT) och befintliga (UPDATE) url:er, så körs aldrig
+# konflikthanteringen i en UPSERT. row_hash är radens innehållshash och
+# load_ts samma tidsstämpel för hela laddningen.
+INSERT_SQL = """
 insert into fact_cars (
-    url, regnr, model_year, price_sek, odometer_km, fuel, body_type, horsepower, price_per_1000km, load_ts
-) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-on conflict(url) do update set
-    regnr=excluded.regnr,
-    model_year=excluded.model_year,
-    price_sek=excluded.price_sek,
-    odometer_km=excluded.odometer_km,
-    fuel=excluded.fuel,
-    body_type=excluded.body_type,
-    horsepower=excluded.horsepower,
-    price_per_1000km=excluded.price_per_1000km,
-    load_ts=excluded.load_ts;
+    url, regnr, model_year, price_sek, odometer_km, fuel, body_type, horsepower, price_per_1000km, row_hash, load_ts
+) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+"""
+
+# Numrerade parametrar: UPDATE tar samma tupel som INSERT_SQL
+UPDATE_SQL = """
+update fact_cars set
+    regnr=?2,
+    model_year=?3,
+    price_sek=?4,
+    odometer_km=?5,
+    fuel=?6,
+    body_type=?7,
+    horsepower=?8,
+    price_per_1000km=?9,
+    row_hash=?10,
+    load_ts=?11
+where url=?1;
+"""
+
+# Vilka url:er som redan finns och deras row_hash; url-listan skickas som en JSON-array
+# i en enda parameter så att frågan är densamma (och förberedd) oavsett antal url:er
+EXISTING_HASHES_SQL = """
+select url, row_hash from fact_cars where url in (select value from json_each(?));
 """
 
+# Antal rader per executemany-anrop: begränsar minnet och låter WAL-sidor återanvändas
+BATCH_SIZE = 10_000
+
 def get_conn(db_path: Path) -> sqlite3.Connection:
     """
     Öppna en SQLite-anslutning med rimliga prestanda-inställningar.
     """
-    conn = sqlite3.connect(str(db_path), timeout=30.0)
+    # detect_types=0: inga typkonverterare körs när rader läses
+    conn = sqlite3.connect(str(db_path), timeout=30.0, detect_types=0)
+    # Autocommit-läge: transaktioner styrs explicit (se upsert_cars)
+    conn.isolation_level = None
+    conn.text_factory = str
     conn.execute("pragma journal_mode=WAL;")
     conn.execute("pragma synchronous=NORMAL;")
     conn.execute("pragma foreign_keys=on;")
+    conn.execute("pragma cache_size=-65536;")       # ca 64 MB sidcache
+    conn.execute("pragma temp_store=MEMORY;")
+    conn.execute("pragma mmap_size=268435456;")     # 256 MB minnesmappad I/O
+    conn.execute("pragma wal_autocheckpoint=10000;") # färre checkpoints vid stora laddningar
     return conn
 
 def init_schema(conn: sqlite3.Connection) -> None:
     """Skapa tabellen (och index) om de inte finns."""
     with conn:
         conn.executescript(DDL)
+        # Tabeller skapade innan row_hash fanns får kolumnen i efterhand
+        columns = {name for (_, name, *_) in conn.execute("pragma table_info(fact_cars);")}
+        if "row_hash" not in columns:
+            conn.execute("alter table fact_cars add column row_hash integer;")
+
+def _chunks(rows: Iterable[Tuple[Any, ...]], size: int) -> Iterator[List[Tuple[Any, ...]]]:
+    """Dela upp raderna i listor med högst size rader."""
+    it = iter(rows)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+def _existing_hashes(conn: sqlite3.Connection, urls: Iterable[str]) -> Dict[str, Optional[int]]:
+    """Returnera url -> row_hash för de url:er som redan finns i fact_cars."""
+    return dict(conn.execute(EXISTING_HASHES_SQL, (json.dumps(list(urls)),)))
 
 def upsert_cars(conn: sqlite3.Connection, rows: Iterable[Tuple[Any, ...]]) -> int:
     """
-    Kör idempotent UPSERT för alla rader.
-    Returnerar antalet rader som skickades till UPSERT.
+    Kör idempotent UPSERT för alla rader: nya url:er infogas, befintliga uppdateras
+    om row_hash (radens näst sista fält, före load_ts) har ändrats och lämnas
+    annars orörda.
+    Returnerar antalet rader som faktiskt skrevs.
     """
-    rows_list = list(rows)
-    if not rows_list:
-        return 0
-    with conn:
-        conn.executemany(UPSERT_SQL, rows_list)
-    return len(rows_list)
+    duplicates = 0
+    # url:er som setts resp. skrivits i denna laddning, även över batchgränser
+    seen: Set[str] = set()
+    written: Set[str] = set()
+    # En enda transaktion runt hela laddningen ger en fsync i stället för en per rad,
+    # raderna skickas i batchar så att hela indata aldrig ligger i minnet samtidigt
+    conn.execute("begin immediate;")
+    try:
+        for batch in _chunks(rows, BATCH_SIZE):
+            # Sista raden per url vinner och hamnar på sin sista position, som med
+            # drop_duplicates(keep="last"), så att regnr släpps i rätt ordning
+            latest: Dict[str, Tuple[Any, ...]] = {}
+            for row in batch:
+                latest.pop(row[0], None)
+                latest[row[0]] = row
+            duplicates += len(batch) - len(latest) + sum(1 for url in latest if url in seen)
+            seen.update(latest)
+            existing = _existing_hashes(conn, latest)
+            new_rows = [row for url, row in latest.items() if url not in existing]
+            # Oförändrade rader (samma hash) hoppas över, så skrivs inga tomma uppdateringar
+            changed_rows = [
+                row
+                for url, row in latest.items()
+                if url in existing and existing[url] != row[9]
+            ]
+            # Uppdateringar först: en befintlig rad kan släppa ett regnr som en ny rad tar
+            conn.executemany(UPDATE_SQL, changed_rows)
+            conn.executemany(INSERT_SQL, new_rows)
+            # En url som skrivs igen i en senare batch räknas bara en gång
+            written.update(row[0] for row in changed_rows)
+            written.update(row[0] for row in new_rows)
+        conn.execute("commit;")
+        if duplicates:
+            LOGGER.info("Load: %d dubbletter (url) borttagna", duplicates)
+    finally:
+        # Vid alla fel (även KeyboardInterrupt) rullas transaktionen tillbaka,
+        # så lämnas anslutningen aldrig med en öppen transaktion
+        if conn.in_transaction:
+            conn.execute("rollback;")
+    return len(written)
@@ -3,9 +3,10 @@ from __future__ import annotations
 
 import argparse
 import logging
+from itertools import repeat
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
-from typing import List, Tuple, Any, Iterable
+from typing import Iterator, List, Tuple, Any
 from datetime import datetime, timezone
 
 import numpy as np
@@ -19,15 +20,23 @@ LOGGER = logging.getLogger("etl_cars")
 
 # Hjälpfunktioner: loggning
 
+# Sätts när loggningen har konfigurerats, så görs det bara en gång per process
+_LOGGING_CONFIGURED = False
+
 def _setup_logging(log_path: Path, level: int = logging.INFO) -> None:
     """Initiera fil- och konsolloggning."""
+    global _LOGGING_CONFIGURED
+    LOGGER.setLevel(level) #nivån sätts vid varje anrop
+    if _LOGGING_CONFIGURED:
+        return
+
     log_path.parent.mkdir(parents=True, exist_ok=True)
-    LOGGER.setLevel(level)
     fmt = logging.Formatter("%(asctime)s %(levelname)s %(name)s - %(message)s")
 
     if not any(isinstance(h, RotatingFileHandler) for h in LOGGER.handlers):
         file_handler = RotatingFileHandler(
-            log_path, maxBytes=1_000_000, backupCount=5, encoding="utf-8"
+            log_path, maxBytes=1_000_000, backupCount=5, encoding="utf-8",
+            delay=True, #filen öppnas först när något loggas
         )
         file_handler.setFormatter(fmt)
         LOGGER.addHandler(file_handler)
@@ -37,6 +46,8 @@ def _setup_logging(log_path: Path, level: int = logging.INFO) -> None:
         stream_handler.setFormatter(fmt)
         LOGGER.addHandler(stream_handler)
 
+    _LOGGING_CONFIGURED = True
+
 
 # Extrahera
 
@@ -45,8 +56,15 @@ def extract_excel(path: Path, sheet: str | int | None = None) -> pd.DataFrame:
     """Läs Excel-fil till DataFrame."""
     LOGGER.info("Extract: läser Excel %s (sheet=%s)", path, sheet)
     try:
-        #Läser in Excelfilen om inget blad anges tas det första
-        df = pd.read_excel(path, sheet_name=sheet) #path: sökväg till excel-fil, sheet:bladnamn eller index
+        #Läser in Excelfilen om inget blad anges tas det första.
+        #Bara kolumnerna i COLUMN_MAP parsas, och textkolumnerna läses direkt som strängar
+        df = pd.read_excel(
+            path, #sökväg till excel-fil
+            sheet_name=sheet, #bladnamn eller index
+            usecols=lambda c: c in COLUMN_MAP, #saknade kolumner hanteras i _normalize_columns
+            dtype=_EXCEL_DTYPES,
+            engine="calamine", #Rust-baserad läsare, betydligt snabbare än openpyxl
+        )
         # Om pd returnerar en dict vid flera blad plockas det första bladet
         if not isinstance(df, pd.DataFrame):
             df = next(iter(df.values()))
@@ -77,60 +95,64 @@ COLUMN_MAP = {
     "Hästkrafter": "horsepower",
 }
 
+# Arrow-baserade strängar: strip/jämförelser körs i pyarrows C++-kärnor
+_STRING_DTYPE = "string[pyarrow]"
+
+# Textkolumner
+_STRING_COLS = ["url", "regnr", "fuel", "body_type"]
+
+# Textkolumner i Excel som läses in som strängar redan vid parsning
+_EXCEL_DTYPES = {
+    "Url": _STRING_DTYPE,
+    "Registreringsnummer": _STRING_DTYPE,
+    "Bränsle": _STRING_DTYPE,
+    "Biltyp": _STRING_DTYPE,
+}
+
 # Numeriska kolumner konverteras till taltyper
 _NUMERIC_COLS = {"model_year", "price_sek", "odometer_km", "horsepower"}
 
-# Hämtar en kolumn från df om den finns, annars returneras en serie fylld med NA. 
-def _safe_get(df: pd.DataFrame, col: str) -> pd.Series:
-    if col in df.columns:
-        return df[col]
-    return pd.Series([pd.NA] * len(df))
-
 
 def _normalize_columns(df: pd.DataFrame) -> pd.DataFrame:
-    out = pd.DataFrame(index=df.index)
-    
-    # Byt ut komlumnnamn enligt vår map
-    for src, dest in COLUMN_MAP.items():
-        out[dest] = _safe_get(df, src)
+    # Byt ut kolumnnamn enligt vår map, kolumner som saknas fylls med NA
+    out = df.rename(columns=COLUMN_MAP).reindex(columns=list(COLUMN_MAP.values()))
     
     #Ersätt tomma strängar med NA    
-    for s in ["url", "regnr", "fuel", "body_type"]:
-        out[s] = out[s].astype("string").str.strip().replace({"": pd.NA})
+    for s in _STRING_COLS:
+        out[s] = out[s].astype(_STRING_DTYPE).str.strip().replace("", pd.NA)
         
     #Konvertera numeriska fält till tal    
     for ncol in _NUMERIC_COLS:
-        out[ncol] = pd.to_numeric(out[ncol], errors="coerce")
-        out[ncol] = out[ncol].astype("Int64")
+        out[ncol] = pd.to_numeric(out[ncol], errors="coerce").astype("Int64")
 
     return out
 
 
+def _price_per_1000km(price: np.ndarray, odo: np.ndarray) -> np.ndarray:
+    # Alla steg skriver i samma förallokerade array (out=) så att inga
+    # temporära arrayer skapas för division, multiplikation och avrundning
+    result = np.full_like(price, np.nan)
+    np.divide(price, odo, out=result, where=odo > 0) #övriga rader förblir NaN
+    np.multiply(result, 1000.0, out=result)
+    np.round(result, 2, out=result)
+    return result
+
+
 def transform_cars(df: pd.DataFrame) -> pd.DataFrame:
     LOGGER.info("Transform: normaliserar kolumner och beräknar fält")
 
     out = _normalize_columns(df)
     
-    #Priset och mätarställning som flyttal för beräkning
-    price = out["price_sek"].astype("float")
-    odo = out["odometer_km"].astype("float")
-    
-    #Beräkna pris per 1000 km och undvik division med noll och NAN
-    with np.errstate(divide="ignore", invalid="ignore"):
-        p_per_1000 = (price / odo) * 1000.0
-    invalid = (price.isna()) | (odo.isna()) | (odo == 0)
-    p_per_1000 = p_per_1000.mask(invalid)
-    out["price_per_1000km"] = p_per_1000.round(2)
+    #Priset och mätarställning som flyttal (NA -> NaN) direkt som NumPy-arrayer
+    price = out["price_sek"].to_numpy(dtype=np.float64, na_value=np.nan)
+    odo = out["odometer_km"].to_numpy(dtype=np.float64, na_value=np.nan)
     
-    #Filtrera bort rader utan URL
-    out = out[out["url"].notna()]
+    #Beräkna pris per 1000 km, NaN där mätarställningen saknas eller är noll
+    out["price_per_1000km"] = _price_per_1000km(price, odo)
     
-    #Ta bort dubbletter på URL och behåll sista
-    before = len(out)
-    out = out.drop_duplicates(subset=["url"], keep="last")
-    removed = before - len(out)
-    if removed:
-        LOGGER.info("Transform: %d dubbletter (url) borttagna", removed)
+    #Filtrera bort rader utan URL. Dubbletter på URL tas inte bort här utan i
+    #db_cars.upsert_cars, där sista raden per url vinner utan en extra DataFrame-kopia
+    out = out.loc[out["url"].notna()]
     
     #Återsäll index så raderna blir 0..n    
     out.reset_index(drop=True, inplace=True)
@@ -140,36 +162,42 @@ def transform_cars(df: pd.DataFrame) -> pd.DataFrame:
 
 # Ladda till databasen
 
-def _convert_row_for_db(rows: Iterable[pd.Series]) -> List[Tuple[Any, ...]]:
-    out_rows: List[Tuple[Any, ...]] = []
-    now = datetime.now(timezone.utc).isoformat() #tidsstämpel i ISO-format (UTC)
-
-    for r in rows:
-        # Hjälpfunktion: om värdet är NaN eller None då returnera None,
-        # annars returnera värdet, ev. typkonverterat med cast
-        def _none(v: Any, cast: Any | None = None):
-            if v is None or (isinstance(v, float) and np.isnan(v)) or pd.isna(v):
-                return None
-            return cast(v) if cast else v
-        
-        #Bygger upp en tupel med fälten i rätt ordning som matchar tabellen i databasen.
-
-        out_rows.append(
-            (
-                _none(r[0], str), # url
-                _none(r[1], str), # registreringsnummer
-                _none(r[2], int), # modellår
-                _none(r[3], int), # pris (SEK)
-                _none(r[4], int), # mätarställning (km)
-                _none(r[5], str), # bränsle
-                _none(r[6], str), # biltyp
-                _none(r[7], int), # hästkrafter
-                _none(r[8], float), # pris per 1000 km
-                now,                # tidsstämpel för ETL-laddningen
-            )
-        )
+# Kolumnerna i samma ordning som i tabellen
+_DB_COLUMNS = [
+    "url",               # url
+    "regnr",             # registreringsnummer
+    "model_year",        # modellår
+    "price_sek",         # pris (SEK)
+    "odometer_km",       # mätarställning (km)
+    "fuel",              # bränsle
+    "body_type",         # biltyp
+    "horsepower",        # hästkrafter
+    "price_per_1000km",  # pris per 1000 km
+]
+
+
+def _column_for_db(col: pd.Series) -> List[Any]:
+    # Ersätt NaN/NA med None för hela kolumnen i ett enda pass: to_numpy läser
+    # Int64-kolumnens data- och maskbuffert en gång, utan mellanliggande Series.
+    # Resultatet är inbyggda Python-typer (int/float/str/None) som sqlite3 binder direkt
+    return col.to_numpy(dtype=object, na_value=None).tolist()
+
+
+def _row_hashes(df: pd.DataFrame) -> List[int]:
+    # Stabil 64-bitars innehållshash per rad, beräknad vektoriserat av pandas.
+    # uint64 tolkas om som int64 eftersom SQLite lagrar heltal med tecken
+    hashes = pd.util.hash_pandas_object(df[_DB_COLUMNS], index=False)
+    return hashes.to_numpy().view(np.int64).tolist()
+
+
+def _convert_row_for_db(df: pd.DataFrame, load_ts: str) -> Iterator[Tuple[Any, ...]]:
+    # Konvertera kolumnvis i stället för rad för rad
+    columns = [_column_for_db(df[name]) for name in _DB_COLUMNS]
 
-    return out_rows
+    #Bygger tupler med fälten i rätt ordning som matchar tabellen i databasen,
+    #sist radens hash (row_hash) och tidsstämpeln (load_ts), samma sträng för alla rader.
+    #zip är lat så tuplerna skapas först när upsert_cars läser dem
+    return zip(*columns, _row_hashes(df), repeat(load_ts))
 
 #Laddar in transformad df till SQLite-databasen
 def load_cars(df: pd.DataFrame, db_path: Path) -> int:
@@ -177,9 +205,10 @@ def load_cars(df: pd.DataFrame, db_path: Path) -> int:
     conn = db_cars.get_conn(db_path) # anslutning till databasen
     try:
         db_cars.init_schema(conn) # säkerställ att tabellen finns 
-        rows = _convert_row_for_db(df.itertuples(index=False, name=None)) #Konvertera rader
-        affected = db_cars.upsert_cars(conn, rows) #infoga coh uppdatera rader
-        LOGGER.info("Load: %d rader upsertade.", affected)
+        now = datetime.now(timezone.utc).isoformat() #tidsstämpel i ISO-format (UTC)
+        rows = _convert_row_for_db(df, now) #Konvertera rader
+        affected = db_cars.upsert_cars(conn, rows) #infoga och uppdatera rader
+        LOGGER.info("Load: %d rader upsertade (oförändrade hoppades över).", affected)
         return affected
     finally:
         conn.close() #stäng anslutningen 
@@ -1,7 +1,9 @@
 import sqlite3
 import pandas as pd
+import pytest
 from pathlib import Path
 
+import db_cars
 import etl_cars
 
 def test_transform_cars():
@@ -53,3 +55,136 @@ def test_load_cars(tmp_path):
 
     assert row == ("ABC123", 200000)
 
+
+
+def test_convert_row_for_db_handles_missing_values():
+    df = etl_cars.transform_cars(pd.DataFrame({
+        "Url": ["http://test.se/1"],
+        "Registreringsnummer": [None],
+        "Modellår": [2020],
+        "Pris (kr)": [200000],
+        "Mätarställning (km)": [None],
+        "Bränsle": ["Bensin"],
+        "Biltyp": [""],
+        "Hästkrafter": [150],
+    }))
+
+    (row,) = etl_cars._convert_row_for_db(df, "2025-01-01T00:00:00+00:00")
+
+    # NA/NaN blir None och tal blir inbyggda Python-typer
+    assert row[:9] == ("http://test.se/1", None, 2020, 200000, None, "Bensin", None, 150, None)
+    assert type(row[2]) is int
+    assert row[10] == "2025-01-01T00:00:00+00:00"
+
+
+def test_load_cars_skips_unchanged_rows(tmp_path):
+    df = etl_cars.transform_cars(pd.DataFrame({
+        "Url": ["http://test.se/1", "http://test.se/2"],
+        "Pris (kr)": [200000, 150000],
+        "Mätarställning (km)": [5000, 10000],
+    }))
+    db_path = tmp_path / "test.db"
+
+    assert etl_cars.load_cars(df, db_path) == 2
+    # Samma data igen: inget skrivs
+    assert etl_cars.load_cars(df, db_path) == 0
+
+    # Bara den ändrade raden skrivs
+    df.loc[1, "price_sek"] = 140000
+    assert etl_cars.load_cars(df, db_path) == 1
+
+    con = sqlite3.connect(db_path)
+    rows = con.execute("SELECT url, price_sek FROM fact_cars ORDER BY url").fetchall()
+    con.close()
+    assert rows == [("http://test.se/1", 200000), ("http://test.se/2", 140000)]
+
+
+def test_load_cars_keeps_last_duplicate(tmp_path, caplog):
+    df = etl_cars.transform_cars(pd.DataFrame({
+        "Url": ["http://test.se/1", "http://test.se/1"],
+        "Pris (kr)": [200000, 190000],
+    }))
+    db_path = tmp_path / "test.db"
+
+    with caplog.at_level("INFO", logger="etl_cars"):
+        etl_cars.load_cars(df, db_path)
+    assert "1 dubbletter (url) borttagna" in caplog.text
+
+    # Sista raden per url vinner
+    con = sqlite3.connect(db_path)
+    rows = con.execute("SELECT url, price_sek FROM fact_cars").fetchall()
+    con.close()
+    assert rows == [("http://test.se/1", 190000)]
+
+
+def test_upsert_cars_rolls_back_on_interrupt(tmp_path):
+    conn = db_cars.get_conn(tmp_path / "test.db")
+    db_cars.init_schema(conn)
+
+    def rows():
+        yield ("http://test.se/1", None, None, None, None, None, None, None, None, 1, "ts")
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        db_cars.upsert_cars(conn, rows())
+
+    # Ingen öppen transaktion kvar, och anslutningen går att använda igen
+    assert not conn.in_transaction
+    row = ("http://test.se/2", None, None, None, None, None, None, None, None, 2, "ts")
+    assert db_cars.upsert_cars(conn, [row]) == 1
+    conn.close()
+
+
+def test_upsert_cars_moves_regnr_to_new_row(tmp_path):
+    conn = db_cars.get_conn(tmp_path / "test.db")
+    db_cars.init_schema(conn)
+    empty = (None,) * 7
+    db_cars.upsert_cars(conn, [("u1", "X") + empty + (1, "ts")])
+
+    # u1 byter regnr till Y samtidigt som den nya u2 tar X
+    affected = db_cars.upsert_cars(conn, [("u1", "Y") + empty + (2, "ts"), ("u2", "X") + empty + (3, "ts")])
+
+    assert affected == 2
+    rows = conn.execute("SELECT url, regnr FROM fact_cars ORDER BY url").fetchall()
+    conn.close()
+    assert rows == [("u1", "Y"), ("u2", "X")]
+
+
+def test_upsert_cars_keeps_last_position_of_duplicates(tmp_path):
+    conn = db_cars.get_conn(tmp_path / "test.db")
+    db_cars.init_schema(conn)
+    empty = (None,) * 7
+    db_cars.upsert_cars(conn, [("e1", "A") + empty + (1, "ts"), ("e2", "X") + empty + (2, "ts")])
+
+    # e2 släpper X innan den sista e1-raden tar det
+    affected = db_cars.upsert_cars(conn, [
+        ("e1", "A") + empty + (1, "ts"),
+        ("e2", "W") + empty + (3, "ts"),
+        ("e1", "X") + empty + (4, "ts"),
+    ])
+
+    assert affected == 2
+    rows = conn.execute("SELECT url, regnr FROM fact_cars ORDER BY url").fetchall()
+    conn.close()
+    assert rows == [("e1", "X"), ("e2", "W")]
+
+
+def test_upsert_cars_counts_duplicates_across_batches(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(db_cars, "BATCH_SIZE", 2)
+    conn = db_cars.get_conn(tmp_path / "test.db")
+    db_cars.init_schema(conn)
+    empty = (None,) * 7
+
+    # u1 återkommer i nästa batch: skrivs igen (sista vinner) men räknas en gång
+    with caplog.at_level("INFO", logger="etl_cars"):
+        affected = db_cars.upsert_cars(conn, [
+            ("u1", "A") + empty + (1, "ts"),
+            ("u2", "B") + empty + (2, "ts"),
+            ("u1", "C") + empty + (3, "ts"),
+        ])
+
+    assert affected == 2
+    assert "1 dubbletter (url) borttagna" in caplog.text
+    rows = conn.execute("SELECT url, regnr FROM fact_cars ORDER BY url").fetchall()
+    conn.close()
+    assert rows == [("u1", "C"), ("u2", "B")]